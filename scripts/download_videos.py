@@ -2,14 +2,41 @@
 Download TikTok videos
 '''
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import pyktok as pyk
+import diskcache
 import time
+import random
+import threading
 import requests
-from requests.exceptions import ReadTimeout
+from requests.adapters import HTTPAdapter
 import os
+import csv
+import struct
+import itertools
 from pathlib import Path
+from urllib.parse import urlparse
 import logging
-import sys
+import argparse
+from retry_utils import retry_after
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+def positive_float(value):
+    """
+    Parses a command line value that must be a number greater than zero.
+
+    Args:
+        value (str): Raw command line value.
+
+    Returns:
+        float: The parsed value.
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
 
 def setup_logging(file_path):
     """
@@ -28,126 +55,365 @@ def setup_logging(file_path):
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
-def isPrivate(row):
+class RateLimiter:
+    """
+    Token bucket that throttles requests per host, shared by all worker threads.
+
+    Args:
+        rate (float): Requests allowed per second for each host.
+        capacity (int): Maximum burst of requests for each host.
+    """
+    def __init__(self, rate=1.0, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Blocks until a request to the URL's host is allowed.
+
+        Args:
+            url (str): URL about to be requested.
+        """
+        host = urlparse(url).netloc
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(host, (self.capacity, now))
+                tokens = min(self.capacity, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self.buckets[host] = (tokens - 1, now)
+                    return
+                self.buckets[host] = (tokens, now)
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+rate_limiter = RateLimiter()
+
+def _backoff(attempt, base=1.0, cap=60.0):
+    """
+    Computes an exponential backoff delay with jitter.
+
+    Args:
+        attempt (int): Zero-based index of the failed attempt.
+        base (float): Delay in seconds after the first failure.
+        cap (float): Maximum delay in seconds before jitter.
+
+    Returns:
+        float: Seconds to sleep before the next attempt.
+    """
+    return min(cap, base * (2 ** attempt)) + random.random()
+
+def raise_on_rate_limit(response, *args, **kwargs):
+    """
+    Response hook that turns HTTP 429 responses into errors so retry loops can honor them.
+
+    Args:
+        response (requests.Response): Response returned by the server.
+    """
+    if response.status_code == 429:
+        response.raise_for_status()
+
+# Shared by pyktok and the downloader so connections are reused across threads
+# and rate limit responses surface in every retry loop
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+session.hooks['response'].append(raise_on_rate_limit)
+pyk.requests = session
+
+cache = diskcache.Cache('.tiktok_cache')
+
+# webapp.video-detail status codes meaning the video is gone for good: the video or its
+# account was deleted, banned, or made private
+VIDEO_GONE_STATUS_CODES = {10202, 10204, 10216, 10221, 10222}
+
+@cache.memoize(expire=86400)
+def get_item_struct(video_page_url):
+    """
+    Fetches a video's item metadata, caching the result on disk so reruns skip the network.
+
+    Pages without item metadata (bot checks, unexpected status codes) raise instead of
+    returning, so they are retried and never cached.
+
+    Args:
+        video_page_url (str): Formatted TikTok video URL.
+
+    Returns:
+        dict: Video item metadata, or None if the video no longer exists.
+    """
+    rate_limiter.wait(video_page_url)
+    tt_json = pyk.alt_get_tiktok_json(video_page_url)
+    video_detail = tt_json["__DEFAULT_SCOPE__"].get('webapp.video-detail')
+    if video_detail is None:
+        raise ValueError(f"No video detail in page: {video_page_url}")
+    if 'itemInfo' not in video_detail:
+        if video_detail.get('statusCode') in VIDEO_GONE_STATUS_CODES:
+            return None
+        raise ValueError(f"Unexpected status code {video_detail.get('statusCode')}: {video_page_url}")
+    return video_detail['itemInfo']['itemStruct']
+
+def isPrivate(video_page_url):
     """
     Checks if a TikTok video is publicly available.
 
     Args:
-        row (pd.Series): Row of the DataFrame containing video metadata.
+        video_page_url (str): Formatted TikTok video URL.
 
     Returns:
-        bool: True if public, False if private.
+        tuple: (bool, dict) True if public, False if private or removed, None if every
+            attempt failed and the status could not be determined, and the video's
+            item metadata (None if it could not be fetched).
     """
-    username = row['username']
-    video_id = row['id']
     max_attempts = 10
 
     for attempt in range(max_attempts):
         try:
-            tt_json = pyk.alt_get_tiktok_json(f"https://www.tiktok.com/@{username}/video/{video_id}?is_copy_url=1&is_from_webapp=v1")
-            private_status = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['privateItem']
-            return not private_status
+            item_struct = get_item_struct(video_page_url)
+            if item_struct is None:
+                return False, None
+            return not item_struct['privateItem'], item_struct
         except Exception as e:
-            if isinstance(e, ReadTimeout):
-                if attempt < max_attempts - 1:
-                    time.sleep(100)
-                else:
-                    return False
-            elif "webapp.video-detail" in str(e):
-                return False
+            if attempt < max_attempts - 1:
+                delay = retry_after(getattr(e, 'response', None))
+                time.sleep(_backoff(attempt) if delay is None else delay)
             else:
-                if attempt < max_attempts - 1:
-                    time.sleep(100)
-                else:
-                    return False
+                logging.error(f"Could not determine availability: {video_page_url}")
+                return None, None
 
-def is_mp4_file(file_path):
+def format_url(url):
     """
-    Validates if the downloaded file is a valid MP4.
+    Formats TikTok video URLs.
 
     Args:
-        file_path (str): Path to the file.
+        url (str or pd.Series): URL of the video, or a column of URLs.
 
     Returns:
-        bool: True if valid MP4, False otherwise.
+        str or pd.Series: Formatted URL(s).
     """
-    try:
-        with open(file_path, 'rb') as file:
-            header = file.read(12)
-            return header[4:8] == b'ftyp'
-    except IOError:
-        return False
+    return url + '?is_copy_url=1&is_from_webapp=v1'
 
-def format_url(url):
+# Boxes that may follow ftyp at the top level of an MP4 file
+MP4_BOX_TYPES = {b'moov', b'mdat', b'free', b'skip', b'wide', b'uuid', b'pdin', b'moof', b'sidx', b'styp', b'meta'}
+
+def save_video(video_url, video_file_path):
     """
-    Formats a TikTok video URL.
+    Downloads a TikTok video by streaming it to disk, validating the MP4
+    header on the first chunk before anything is written.
+
+    The ftyp box size is read from the header to check that a known box follows it
+    and that the file extends past it; a download shorter than its Content-Length
+    raises so it is retried. The stream is written to a .part file that is only
+    moved to video_file_path once it validates, and removed otherwise.
 
     Args:
-        url (str): URL of the video.
+        video_url (str): Direct URL of the video stream.
+        video_file_path (str): Path to save the MP4 file.
 
     Returns:
-        str: Formatted URL.
+        bool: True if a valid MP4 was saved, False otherwise.
     """
-    return url + '?is_copy_url=1&is_from_webapp=v1'
+    headers = dict(pyk.headers, referer='https://www.tiktok.com/')
+    part_file_path = video_file_path + '.part'
+    rate_limiter.wait(video_url)
+    try:
+        with session.get(video_url, headers=headers, cookies=pyk.cookies, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            chunks = r.iter_content(chunk_size=65536)
+            first_chunk = next(chunks, b'')
+            if len(first_chunk) < 8 or first_chunk[4:8] != b'ftyp':
+                return False
 
-def save_video(url):
-    """
-    Downloads a TikTok video.
+            ftyp_size = struct.unpack('>I', first_chunk[:4])[0]
+            next_box_type = first_chunk[ftyp_size + 4:ftyp_size + 8]
+            if len(next_box_type) == 4 and next_box_type not in MP4_BOX_TYPES:
+                return False
 
-    Args:
-        url (str): Formatted TikTok video URL.
-    """
-    pyk.save_tiktok(url, save_video=True, browser_name="chrome")
+            bytes_written = 0
+            with open(part_file_path, 'wb') as f:
+                for chunk in itertools.chain([first_chunk], chunks):
+                    f.write(chunk)
+                    bytes_written += len(chunk)
+
+            content_length = r.headers.get('Content-Length')
+            if content_length is not None and 'Content-Encoding' not in r.headers and bytes_written < int(content_length):
+                raise IOError(f"Truncated download: {bytes_written} of {content_length} bytes")
+
+        if bytes_written <= ftyp_size + 8:
+            return False
 
-def download(row, video_folder_path):
+        os.replace(part_file_path, video_file_path)
+        return True
+    finally:
+        # Partial downloads never reach the final path
+        if os.path.exists(part_file_path):
+            os.remove(part_file_path)
+
+def download(video_page_url, item_struct, video_file_path):
     """
     Downloads a video and validates the file.
 
     Args:
-        row (pd.Series): Row of the DataFrame containing video metadata.
-        video_folder_path (str): Path to the folder for storing downloaded videos.
+        video_page_url (str): Formatted TikTok video URL.
+        item_struct (dict): Video item metadata returned by isPrivate.
+        video_file_path (str): Path to save the MP4 file.
 
     Returns:
         bool: True if the MP4 is valid, False otherwise.
     """
-    url = row['tiktokurl']
     max_attempts = 5
 
     for attempt in range(max_attempts):
         try:
-            time.sleep(10)
-            formatted_url = format_url(url)
-            save_video(formatted_url)
-            video_file_path = os.path.join(video_folder_path, f"@{row['username']}_video_{row['id']}.mp4")
-            return is_mp4_file(video_file_path)
+            if attempt > 0:
+                item_struct = get_item_struct(video_page_url)
+
+            video = (item_struct or {}).get('video', {})
+            video_url = video.get('playAddr') or video.get('downloadAddr')
+            if not video_url:
+                logging.error(f"No video stream found: {video_page_url}")
+                return False
+
+            return save_video(video_url, video_file_path)
         except Exception as e:
+            # The cached play address may have expired, so refetch it on the next attempt
+            cache.delete(get_item_struct.__cache_key__(video_page_url))
             if attempt < max_attempts - 1:
-                time.sleep(100)
+                delay = retry_after(getattr(e, 'response', None))
+                time.sleep(_backoff(attempt) if delay is None else delay)
             else:
-                logging.error(f"Failed to download video: {url}")
+                logging.error(f"Failed to download video: {video_page_url}")
                 return False
 
-def process_csv_file(file_path, output_dir, video_dir):
+def fetch_and_download(row, video_folder_path):
+    """
+    Checks a video's availability and downloads it in a single pass, reusing
+    the fetched metadata instead of requesting the video page twice. Only
+    public videos are downloaded, and rows a previous run confirmed as not
+    public (isPublic False in the input) are skipped without any request; rows
+    whose status could not be determined (isPublic empty) are probed again.
+
+    Args:
+        row (namedtuple): Row of the DataFrame containing video metadata.
+        video_folder_path (str): Path to the folder for storing downloaded videos.
+
+    Returns:
+        tuple: (bool, bool) Whether the video is public (None if undetermined) and whether the MP4 is valid.
+    """
+    # CSV input holds the string 'False', Parquet input a boolean
+    if str(getattr(row, 'isPublic', None)) == 'False':
+        return False, False
+
+    is_public, item_struct = isPrivate(row.video_page_url)
+    if not is_public:
+        return is_public, False
+
+    video_file_path = os.path.join(video_folder_path, f"@{row.username}_video_{row.id}.mp4")
+    return True, download(row.video_page_url, item_struct, video_file_path)
+
+def run_in_pool(func, rows, max_workers, *args):
+    """
+    Applies a function to every row concurrently using a thread pool.
+
+    Only a bounded number of rows are submitted at a time, so memory stays
+    flat no matter how many rows are processed.
+
+    Args:
+        func (callable): Function taking a row (plus any extra args).
+        rows (iterable): Rows of the DataFrame.
+        max_workers (int): Number of worker threads.
+        *args: Extra positional arguments passed to func.
+
+    Returns:
+        list: Results in the same order as rows.
+    """
+    results = {}
+    max_pending = max_workers * 2
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for idx, row in enumerate(rows):
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            pending[executor.submit(func, row, *args)] = idx
+
+        for future in as_completed(pending):
+            results[pending[future]] = future.result()
+
+    return [results[idx] for idx in range(len(results))]
+
+def process_csv_file(file_path, output_dir, video_dir, max_workers=16, block_size=1 << 20, write_csv=False):
     """
     Processes a CSV file to download videos and save metadata.
 
+    The CSV is streamed in blocks with pyarrow's multithreaded parser so memory use does not grow
+    with the size of the file. Every column is read as a string, so ids and other values are
+    written back exactly as they appear in the input. A Parquet file (such as the output of a
+    previous run) is also accepted and is streamed in batches of rows.
+
     Args:
-        file_path (Path): Path to the CSV file.
+        file_path (Path): Path to the CSV or Parquet file.
         output_dir (str): Directory to save processed metadata.
         video_dir (str): Directory to save downloaded videos.
+        max_workers (int): Number of concurrent download threads.
+        block_size (int): Number of bytes read from a CSV at a time.
+        write_csv (bool): Whether to save processed metadata as CSV instead of Parquet.
     """
     start_time = time.time()
-    df = pd.read_csv(file_path)
 
     os.makedirs(output_dir, exist_ok=True)
     video_folder_path = os.path.join(video_dir, file_path.stem)
     os.makedirs(video_folder_path, exist_ok=True)
 
-    df['isPublic'] = df.apply(isPrivate, axis=1)
-    df['mp4_isValid'] = df.apply(download, axis=1, args=(video_folder_path,))
+    output_file = os.path.join(output_dir, f"{file_path.stem}_processed.{'csv' if write_csv else 'parquet'}")
+    first_chunk = True
+    parquet_writer = None
+
+    if file_path.suffix == '.parquet':
+        parquet_file = pq.ParquetFile(file_path)
+        input_schema = parquet_file.schema_arrow
+        reader = parquet_file.iter_batches(batch_size=1024)
+    else:
+        with open(file_path, newline='') as f:
+            column_names = next(csv.reader(f))
+
+        reader = pacsv.open_csv(
+            file_path,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=block_size),
+            convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in column_names})
+        )
+        input_schema = reader.schema
+
+    try:
+        for batch in reader:
+            df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+            video_page_urls = format_url("https://www.tiktok.com/@" + df['username'].astype(str) + "/video/" + df['id'].astype(str))
+            rows = df.assign(video_page_url=video_page_urls).itertuples(index=False)
+            results = run_in_pool(fetch_and_download, rows, max_workers, video_folder_path)
+            df[['isPublic', 'mp4_isValid']] = pd.DataFrame(results, index=df.index, dtype='boolean')
+
+            if write_csv:
+                df.to_csv(output_file, mode='w' if first_chunk else 'a', header=first_chunk, index=False)
+            else:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(output_file, table.schema, compression='zstd')
+                parquet_writer.write_table(table)
+            first_chunk = False
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
 
-    output_file = os.path.join(output_dir, f"{file_path.stem}_processed.csv")
-    df.to_csv(output_file, index=False)
+    if first_chunk:
+        # Header-only input: still write an empty output file with the output columns
+        fields = [field for field in input_schema if field.name not in ('isPublic', 'mp4_isValid')]
+        output_schema = pa.schema(fields + [pa.field('isPublic', pa.bool_()), pa.field('mp4_isValid', pa.bool_())])
+        if write_csv:
+            pd.DataFrame(columns=output_schema.names).to_csv(output_file, index=False)
+        else:
+            pq.write_table(output_schema.empty_table(), output_file, compression='zstd')
 
     execution_time = time.time() - start_time
     logging.info(f"Processed {file_path} in {execution_time:.2f} seconds")
@@ -155,13 +421,17 @@ def process_csv_file(file_path, output_dir, video_dir):
 if __name__ == "__main__":
     pyk.specify_browser('chrome')
 
-    if len(sys.argv) != 4:
-        print("Usage: python download_videos.py <path_to_csv_file> <output_directory> <video_directory>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Download TikTok videos listed in a CSV or Parquet file.")
+    parser.add_argument("csv_file", type=Path, help="Path to the CSV or Parquet file")
+    parser.add_argument("output_directory", help="Directory to save processed metadata")
+    parser.add_argument("video_directory", help="Directory to save downloaded videos")
+    parser.add_argument("--max-workers", type=int, default=16, help="Number of concurrent download threads")
+    parser.add_argument("--block-size", type=int, default=1 << 20, help="Number of CSV bytes processed at a time")
+    parser.add_argument("--csv", action="store_true", help="Save processed metadata as CSV instead of Parquet")
+    parser.add_argument("--requests-per-second", type=positive_float, default=1.0, help="Request rate allowed per host")
+    args = parser.parse_args()
 
-    csv_file_path = Path(sys.argv[1])
-    output_directory = sys.argv[2]
-    video_directory = sys.argv[3]
+    rate_limiter.rate = args.requests_per_second
 
-    setup_logging(csv_file_path)
-    process_csv_file(csv_file_path, output_directory, video_directory)
+    setup_logging(args.csv_file)
+    process_csv_file(args.csv_file, args.output_directory, args.video_directory, args.max_workers, args.block_size, args.csv)
@@ -4,99 +4,143 @@ Description:
 
 Usage: 
     Requires a text file of the keywords and hashtags, contained in a specified directory.
-    Requires the file path to your main CSV file or the file path of where you want the script to save the data.
-    How to run the script: python3 metadata_collection.py
+    Requires the directory of your main Parquet dataset or the directory where you want the script to save the data.
+    How to run the script: python3 metadata_collection.py [--csv]
+    Pass --csv to also write a metadata_<date>.csv file per day for human consumption.
+    Days that could not be fetched completely are not saved and are listed in failed_dates.txt.
 
 Dependencies:
     Required libraries or modules are listed in requirements.txt
 """
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from datetime import datetime, timedelta
 import time
 import csv
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import os
-from requests.exceptions import ChunkedEncodingError
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from urllib3.exceptions import ProtocolError
+from retry_utils import retry_after
 
 # API keys (replace with your actual credentials or store securely)
 client_key = "your_client_key"
 client_secret = "your_client_secret"
 
-def append_to_existing_or_create_new(df, combined_df_path):
+def create_session():
     """
-    Appends the data returned from the API to the main CSV file that contains everything collected thus far.
+    Creates a requests session with a pool of reusable HTTPS connections.
 
-    Args: 
-        df (Pandas DataFrame): DataFrame containing metadata of TikTok videos.
-        combined_df_path (str): File path to the main CSV file.
+    Returns:
+        requests.Session: New session.
     """
-    # Load the existing combined DataFrame
-    if os.path.exists(combined_df_path):
-        combined_df = pd.read_csv(combined_df_path)
-    else:
-        combined_df = pd.DataFrame()
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+    return session
+
+# Reuse connections to the Research API instead of opening a new one per request
+session = create_session()
 
-    # Iterate through each date in the new DataFrame
-    for date in df['utc_date_string'].unique():
-        df_date = df[df['utc_date_string'] == date]
-        date_file_path = f"metadata_{date}.csv"
+def init_worker():
+    """
+    Gives each worker process its own session, so pooled connections opened by the
+    parent (for the token request) are never shared across processes after a fork.
+    """
+    global session
+    session = create_session()
 
-        if os.path.exists(date_file_path):
-            existing_df = pd.read_csv(date_file_path)
-            updated_df = pd.concat([existing_df, df_date], ignore_index=True).drop_duplicates(subset=['id'], keep='first')
-            updated_df.to_csv(date_file_path, index=False)
-        else:
-            df_date.to_csv(date_file_path, index=False)
+def load_seen_ids(combined_dir):
+    """
+    Loads the ids of every video already stored in the main Parquet dataset.
 
-        combined_df = pd.concat([combined_df, df_date], ignore_index=True)
+    The ids are cached in a pickle inside the dataset directory (the leading underscore keeps
+    pyarrow from treating it as data); if it is missing, the id column is read once from the dataset.
+    The pickle is removed once loaded and only rewritten by save_seen_ids when a run finishes, so an
+    interrupted run falls back to reading the dataset instead of trusting stale ids.
 
-    combined_df = combined_df.drop_duplicates(subset=['id'], keep='first')
-    print("Total entries in the combined CSV file:", len(combined_df))
-    combined_df.to_csv(combined_df_path, index=False)
+    Args:
+        combined_dir (str): Directory of the main Parquet dataset.
 
-def save_to_json_file(data, filename):
+    Returns:
+        set: Ids of the videos collected thus far.
     """
-    Saves data to a JSON file.
+    seen_ids_path = os.path.join(combined_dir, "_combined_ids.pkl")
+    if os.path.exists(seen_ids_path):
+        with open(seen_ids_path, 'rb') as f:
+            seen_ids = pickle.load(f)
+        os.remove(seen_ids_path)
+        return seen_ids
+    if not os.path.exists(combined_dir):
+        return set()
+
+    # A directory created by a run that collected nothing holds no data files
+    dataset = ds.dataset(combined_dir, format="parquet", partitioning="hive")
+    if not dataset.files or 'id' not in dataset.schema.names:
+        return set()
+    return set(dataset.to_table(columns=['id'])['id'].to_pylist())
+
+def save_seen_ids(seen_ids, combined_dir):
+    """
+    Saves the ids of every video stored in the main Parquet dataset for the next run.
 
     Args:
-        data (dict): The response from the API and additional attributes.
-        filename (str): Path to the JSON file.
+        seen_ids (set): Ids of the videos collected thus far.
+        combined_dir (str): Directory of the main Parquet dataset.
     """
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+    os.makedirs(combined_dir, exist_ok=True)
+    seen_ids_path = os.path.join(combined_dir, "_combined_ids.pkl")
+    with open(seen_ids_path + ".tmp", 'wb') as f:
+        pickle.dump(seen_ids, f)
+    os.replace(seen_ids_path + ".tmp", seen_ids_path)
 
-def createURL(username, videoid):
+def append_to_existing_or_create_new(df, combined_dir, seen_ids, write_csv=False):
     """
-    Creates the URL for a TikTok post.
+    Appends the data returned from the API to the main Parquet dataset that contains everything collected thus far.
 
-    Args: 
-        username (str): Username of the person who posted the TikTok video.
-        videoid (int): ID of the video.
+    Videos whose id is already in seen_ids are dropped before writing, and each batch is written as
+    new files under its date partitions, so each call costs O(batch) rather than re-reading and
+    deduplicating everything collected so far. Nothing else is rewritten while the run is in progress.
 
-    Returns: 
-        str: The URL to the TikTok post.
+    Args: 
+        df (Pandas DataFrame): DataFrame containing metadata of TikTok videos.
+        combined_dir (str): Directory of the main Parquet dataset.
+        seen_ids (set): Ids already stored; updated in place with the new ids.
+        write_csv (bool): Whether to also append the new videos to per-date CSV files.
     """
-    return f"https://www.tiktok.com/@{username}/video/{videoid}"
+    # Set membership per row keeps this O(batch); isin would rebuild a hashtable of every seen id
+    is_seen = df['id'].map(seen_ids.__contains__).astype(bool)
+    df = df[~is_seen].drop_duplicates(subset=['id'], keep='first')
+
+    if not df.empty:
+        if write_csv:
+            # Iterate through each date in the new DataFrame
+            for date in df['utc_date_string'].unique():
+                df_date = df[df['utc_date_string'] == date]
+                date_file_path = f"metadata_{date}.csv"
+                df_date.to_csv(date_file_path, mode='a', header=not os.path.exists(date_file_path), index=False)
 
-def convert_epoch_to_datetime(input_time):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_to_dataset(table, root_path=combined_dir, partition_cols=['utc_date_string'], compression='zstd')
+
+        seen_ids.update(df['id'].tolist())
+
+def save_to_json_file(data, filename):
     """
-    Converts Epoch/Unix time to UTC time.
+    Saves data to a JSON file.
 
     Args:
-        input_time (int): Time in Epoch/Unix format.
-
-    Returns:
-        pd.Series: Extracted date and time components.
+        data (dict): The response from the API and additional attributes.
+        filename (str): Path to the JSON file.
     """
-    utc_time_stamp = datetime.utcfromtimestamp(input_time)
-    return pd.Series([
-        utc_time_stamp.year, utc_time_stamp.month, utc_time_stamp.day,
-        utc_time_stamp.hour, utc_time_stamp.minute, utc_time_stamp.second,
-        utc_time_stamp.strftime("%Y-%m-%d"), utc_time_stamp.strftime("%H:%M:%S")
-    ])
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=4)
 
 def get_access_token(client_key, client_secret):
     """
@@ -112,7 +156,7 @@ def get_access_token(client_key, client_secret):
     endpoint_url = "https://open.tiktokapis.com/v2/oauth/token/"
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data = {'client_key': client_key, 'client_secret': client_secret, 'grant_type': 'client_credentials'}
-    response = requests.post(endpoint_url, headers=headers, data=data)
+    response = session.post(endpoint_url, headers=headers, data=data, timeout=60)
 
     if response.status_code == 200:
         response_json = response.json()
@@ -121,36 +165,233 @@ def get_access_token(client_key, client_secret):
         print("Error fetching token:", response.json())
         return {}
 
-# Replace sensitive paths and variables
-start_date = "YYYYMMDD"
-combined_file_path = "path_to_combined_file.csv"
-keywords_file_path = "path_to_keywords_and_hashtags.txt"
+token_cache_path = os.path.expanduser("~/.tiktok_token.json")
+
+def get_valid_token(token_info):
+    """
+    Returns access token information that is valid for at least another minute.
+
+    The token is reused from memory or from the on-disk cache when possible and only fetched
+    from the API when it is about to expire; fresh tokens are written back to the cache.
+
+    Args:
+        token_info (dict): Current access token information; updated in place.
+
+    Returns:
+        dict: Valid access token information.
+    """
+    if token_info.get('expires_at', 0) > time.time() + 60:
+        return token_info
+
+    if os.path.exists(token_cache_path):
+        with open(token_cache_path, 'r') as f:
+            cached_token_info = json.load(f)
+        if cached_token_info.get('expires_at', 0) > time.time() + 60:
+            token_info.update(cached_token_info)
+            return token_info
+
+    fresh_token_info = get_access_token(client_key, client_secret)
+    fresh_token_info['expires_at'] = time.time() + fresh_token_info.get('expires_in', 0)
+    token_info.update(fresh_token_info)
+
+    if 'access_token' in fresh_token_info:
+        # Written atomically and readable only by the owner, as workers may refresh concurrently
+        tmp_path = f"{token_cache_path}.{os.getpid()}.tmp"
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(fresh_token_info, f)
+        os.replace(tmp_path, token_cache_path)
 
-# Read keywords and hashtags
-with open(keywords_file_path, 'r') as file:
-    lines = [line.strip() for line in file if line.strip()]
+    return token_info
 
-keywords_list = lines
-hashtags_list = lines
+# Research API limit on the number of values in a single IN condition
+max_terms_per_query = 100
 
-# Fetch access token
-token_info = get_access_token(client_key, client_secret)
-token_info['expires_at'] = time.time() + token_info.get('expires_in', 0)
+video_fields = "id,video_description,create_time,region_code,share_count,view_count,like_count,comment_count,music_id,hashtag_names,username,effect_ids,playlist_id,voice_to_text"
 
-while start_date != "YYYYMMDD_END":
-    end_date_obj = datetime.strptime(start_date, "%Y%m%d") + timedelta(days=1)
-    end_date_str = end_date_obj.strftime("%Y%m%d")
+def build_query(keywords, hashtags):
+    """
+    Builds a Research API query matching videos with any of the keywords or hashtags.
+
+    Args:
+        keywords (list): Keywords to search for.
+        hashtags (list): Hashtags to search for.
+
+    Returns:
+        dict: Query that ORs one IN condition per field.
+    """
+    conditions = []
+    if keywords:
+        conditions.append({"operation": "IN", "field_name": "keyword", "field_values": keywords})
+    if hashtags:
+        conditions.append({"operation": "IN", "field_name": "hashtag_name", "field_values": hashtags})
+    return {"or": conditions}
+
+def fetch_tiktok_data(start_date, end_date, keywords_list, hashtags_list, token_info, max_attempts=5):
+    """
+    Fetches the metadata of every video posted between two dates that matches any keyword or hashtag.
+
+    Keywords and hashtags are OR'ed together in batches of max_terms_per_query, so each day needs
+    one paginated query per batch instead of one per term.
+
+    Args:
+        start_date (str): Start date, formatted as YYYYMMDD.
+        end_date (str): End date, formatted as YYYYMMDD.
+        keywords_list (list): Keywords to search for.
+        hashtags_list (list): Hashtags to search for.
+        token_info (dict): Research API access token information; refreshed when it is about to expire.
+        max_attempts (int): Attempts per page before giving up on the day.
+
+    Returns:
+        tuple: (dict, int) The collected videos under data.videos (None if nothing was found) and their count.
+
+    Raises:
+        RuntimeError: If a page could not be fetched, so a partial day is never returned as complete.
+    """
+    endpoint_url = f"https://open.tiktokapis.com/v2/research/video/query/?fields={video_fields}"
+    headers = {'Content-Type': 'application/json'}
+    videos = []
+
+    for i in range(0, max(len(keywords_list), len(hashtags_list)), max_terms_per_query):
+        keywords = keywords_list[i:i + max_terms_per_query]
+        hashtags = hashtags_list[i:i + max_terms_per_query]
+        body = {"query": build_query(keywords, hashtags), "start_date": start_date, "end_date": end_date, "max_count": 100}
+        has_more = True
+
+        while has_more:
+            for attempt in range(max_attempts):
+                try:
+                    headers['Authorization'] = f"Bearer {get_valid_token(token_info).get('access_token')}"
+                    response = session.post(endpoint_url, headers=headers, json=body, timeout=60)
+                except (requests.RequestException, ProtocolError) as e:
+                    print("Connection error:", e)
+                    time.sleep(2 ** attempt)
+                    continue
+
+                if response.status_code == 200:
+                    try:
+                        page = response.json()['data']
+                        break
+                    except (ValueError, KeyError) as e:
+                        print("Malformed response:", e)
+                        time.sleep(2 ** attempt)
+                        continue
+
+                print("Error fetching data:", response.text)
+                delay = retry_after(response)
+                time.sleep(2 ** attempt if delay is None else delay)
+            else:
+                raise RuntimeError(f"Failed to fetch {start_date}-{end_date} for terms {i} to {i + max_terms_per_query - 1} after {max_attempts} attempts")
+
+            videos.extend(page.get('videos', []))
+            has_more = page.get('has_more', False)
+            body['cursor'] = page.get('cursor')
+            body['search_id'] = page.get('search_id')
+
+    if not videos:
+        return None, 0
+    return {'data': {'videos': videos}}, len(videos)
+
+def fetch_one_day(date_pair, keywords_list, hashtags_list, token_info):
+    """
+    Fetches and prepares the metadata of the videos posted during one day. Runs in a worker process.
+
+    Args:
+        date_pair (tuple): Start and end date of the day, formatted as YYYYMMDD.
+        keywords_list (list): Keywords to search for.
+        hashtags_list (list): Hashtags to search for.
+        token_info (dict): Research API access token information.
+
+    Returns:
+        Pandas DataFrame: Metadata of the fetched videos, or None if nothing was returned.
+
+    Raises:
+        RuntimeError: If the day could not be fetched completely.
+    """
+    start_date, end_date_str = date_pair
     print("Start date:", start_date, "End date:", end_date_str)
 
     # Fetch data and save
     data, total_count = fetch_tiktok_data(start_date, end_date_str, keywords_list, hashtags_list, token_info)
     print("Total videos fetched:", total_count)
 
-    if data:
-        save_to_json_file(data, f"{start_date}_{end_date_str}_metadata.json")
-        df = pd.DataFrame(data['data']['videos'])
-        df['tiktokurl'] = df.apply(lambda row: createURL(row['username'], row['id']), axis=1)
-        df[['utc_year', 'utc_month', 'utc_day', 'utc_hour', 'utc_minute', 'utc_second', 'utc_date_string', 'utc_time_string']] = df['create_time'].apply(convert_epoch_to_datetime)
-        append_to_existing_or_create_new(df, combined_file_path)
+    if not data:
+        return None
+
+    save_to_json_file(data, f"{start_date}_{end_date_str}_metadata.json")
+    df = pd.DataFrame(data['data']['videos'])
+    df['tiktokurl'] = "https://www.tiktok.com/@" + df['username'].astype(str) + "/video/" + df['id'].astype(str)
+    utc_time_stamp = pd.to_datetime(df['create_time'], unit='s', utc=True)
+    df['utc_year'] = utc_time_stamp.dt.year
+    df['utc_month'] = utc_time_stamp.dt.month
+    df['utc_day'] = utc_time_stamp.dt.day
+    df['utc_hour'] = utc_time_stamp.dt.hour
+    df['utc_minute'] = utc_time_stamp.dt.minute
+    df['utc_second'] = utc_time_stamp.dt.second
+    df['utc_date_string'] = utc_time_stamp.dt.strftime("%Y-%m-%d")
+    df['utc_time_string'] = utc_time_stamp.dt.strftime("%H:%M:%S")
+    return df
+
+def daterange(start_date, end_date):
+    """
+    Splits a date range into consecutive one-day windows.
+
+    Args:
+        start_date (str): First day, formatted as YYYYMMDD.
+        end_date (str): Day to stop at (exclusive), formatted as YYYYMMDD.
+
+    Returns:
+        list: (start, end) pairs of dates formatted as YYYYMMDD.
+    """
+    date_pairs = []
+    while start_date != end_date:
+        end_date_str = (datetime.strptime(start_date, "%Y%m%d") + timedelta(days=1)).strftime("%Y%m%d")
+        date_pairs.append((start_date, end_date_str))
+        start_date = end_date_str
+    return date_pairs
+
+# Replace sensitive paths and variables
+start_date = "YYYYMMDD"
+end_date = "YYYYMMDD_END"
+combined_dir_path = "path_to_combined_dataset"
+keywords_file_path = "path_to_keywords_and_hashtags.txt"
+max_workers = 8
+
+if __name__ == "__main__":
+    write_csv = "--csv" in sys.argv
+
+    # Read keywords and hashtags
+    with open(keywords_file_path, 'r') as file:
+        lines = [line.strip() for line in file if line.strip()]
+
+    keywords_list = lines
+    hashtags_list = lines
+
+    # Fetch access token, reusing the cached one if it is still valid
+    token_info = get_valid_token({})
+
+    seen_ids = load_seen_ids(combined_dir_path)
+
+    # Each day is fetched in its own process; results are written back here in date order
+    fetch = partial(fetch_one_day, keywords_list=keywords_list, hashtags_list=hashtags_list, token_info=token_info)
+    failed_dates = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        date_pairs = daterange(start_date, end_date)
+        futures = [executor.submit(fetch, date_pair) for date_pair in date_pairs]
+        for date_pair, future in zip(date_pairs, futures):
+            try:
+                df = future.result()
+            except Exception as e:
+                # Incomplete days are not written, so they can be recollected later
+                print("Skipping incomplete day:", date_pair[0], e)
+                failed_dates.append(date_pair[0])
+                continue
+            if df is not None:
+                append_to_existing_or_create_new(df, combined_dir_path, seen_ids, write_csv)
+
+    save_seen_ids(seen_ids, combined_dir_path)
+    print("Total entries in the combined dataset:", len(seen_ids))
 
-    start_date = end_date_str
+    if failed_dates:
+        with open("failed_dates.txt", 'w') as f:
+            f.write("\n".join(failed_dates) + "\n")
+        print("Days to recollect (saved to failed_dates.txt):", ", ".join(failed_dates))
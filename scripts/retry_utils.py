@@ -0,0 +1,50 @@
+'''
+Retry helpers shared by the collection and download scripts
+'''
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+# Longest wait honored from a server's rate limit headers
+MAX_RETRY_AFTER = 600.0
+
+def retry_after(response, max_delay=MAX_RETRY_AFTER):
+    """
+    Reads how long the server asked us to wait from a rate limited response.
+
+    Retry-After may be a number of seconds or an HTTP date; Ratelimit-Reset may be a
+    number of seconds or, when larger than the current time, an epoch timestamp.
+
+    Args:
+        response (requests.Response): Response of the failed request, or None.
+        max_delay (float): Upper bound on the returned delay in seconds.
+
+    Returns:
+        float: Seconds to wait, or None if the server gave no instruction.
+    """
+    if response is None or response.status_code not in (429, 503):
+        return None
+
+    delay = None
+    value = response.headers.get('Retry-After')
+    if value is not None:
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+
+    value = response.headers.get('Ratelimit-Reset')
+    if delay is None and value is not None:
+        try:
+            delay = float(value)
+        except ValueError:
+            delay = None
+        if delay is not None and delay > time.time():
+            delay -= time.time()
+
+    if delay is None:
+        return None
+    return min(max(0.0, delay), max_delay)